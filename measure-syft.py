@@ -4,11 +4,18 @@ import sys
 import subprocess
 import json
 import statistics
-import datetime
 import requests
+from requests.adapters import HTTPAdapter
 from pathlib import Path
 import multiprocessing
 import argparse
+import shlex
+import hashlib
+import functools
+import time
+import re
+import secrets
+import shutil
 
 # Configuration
 CONFIG = {
@@ -18,115 +25,359 @@ CONFIG = {
     'results_dir': './results',
     'binary_path': 'snapshot/linux-build_linux_amd64_v1/syft',
     'platform': 'linux/amd64',
+    'image_cache': './image-cache',
+    'registry_digest': None,
+    'image_digest': None,
+    'pin_cpus': None,
+    'release_cache_ttl': 3600,
     'current_run': 0
 }
 
+_SESSION = requests.Session()
+_SESSION.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=1))
+_SYFT_ENV_SNAPSHOT = {}
+
 def parse_arguments():
     parser = argparse.ArgumentParser(description='Measure Syft performance across versions')
     parser.add_argument('--pr', help='PR branch to test against main (e.g. feat/parallelize-file-hashing)')
+    parser.add_argument('--pin', metavar='CPUS', type=cpu_list, help='Pin syft runs to a CPU list with taskset and run them SCHED_FIFO (e.g. 2-5)')
     return parser.parse_args()
 
+def parse_cpu_list(cpus):
+    # Same syntax as taskset -c: comma-separated CPUs and ranges, ranges with an optional :stride
+    pinned = set()
+    for part in cpus.split(','):
+        if '-' in part:
+            span, _, stride = part.partition(':')
+            first, last = span.split('-')
+            pinned.update(range(int(first), int(last) + 1, int(stride or 1)))
+        else:
+            pinned.add(int(part))
+    return pinned
+
+def cpu_list(value):
+    try:
+        pinned = parse_cpu_list(value)
+    except ValueError:
+        pinned = set()
+    if not pinned:
+        raise argparse.ArgumentTypeError(f"invalid CPU list: {value!r}")
+    return value
+
+def check_pinning():
+    # chrt needs root or CAP_SYS_NICE; find out now rather than in every measured run
+    result = subprocess.run(
+        ['taskset', '-c', CONFIG['pin_cpus'], 'chrt', '-f', '50', 'true'],
+        capture_output=True,
+        text=True
+    )
+    if result.returncode != 0:
+        raise RuntimeError(f"Unable to pin syft runs to CPUs {CONFIG['pin_cpus']} with SCHED_FIFO: {result.stderr.strip()}")
+
 def setup_environment():
-    cpu_count = multiprocessing.cpu_count()
+    # Size parallelism to the CPUs syft will actually run on
+    if CONFIG['pin_cpus']:
+        cpu_count = len(parse_cpu_list(CONFIG['pin_cpus']))
+    else:
+        cpu_count = multiprocessing.cpu_count()
     os.environ['SYFT_PARALLELISM'] = str(cpu_count * 2)
     os.environ['SYFT_CHECK_FOR_APP_UPDATE'] = 'false'
     
+    # Record the SYFT_ variables the benchmark runs with, for the report header
+    global _SYFT_ENV_SNAPSHOT
+    _SYFT_ENV_SNAPSHOT = {k: v for k, v in os.environ.items() if k.startswith('SYFT_')}
+    
     for directory in [CONFIG['build_dir'], CONFIG['results_dir']]:
         Path(directory).mkdir(exist_ok=True)
+    (Path(CONFIG['results_dir']) / 'logs').mkdir(exist_ok=True)
+
+def _fmt_now(fmt='%Y-%m-%d %H:%M:%S'):
+    return time.strftime(fmt)
 
 def get_log_path(commit_id, run_number):
-    timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
-    log_dir = Path(CONFIG['results_dir']) / 'logs'
-    log_dir.mkdir(exist_ok=True)
-    return log_dir / f"syft_{commit_id}_run{run_number}_{timestamp}.log"
+    timestamp = _fmt_now('%Y-%m-%d_%H%M%S')
+    return Path(CONFIG['results_dir']) / 'logs' / f"syft_{commit_id}_run{run_number}_{timestamp}.log"
+
+def get_registry_digest():
+    # Digest of the top-level manifest the tag points at; a manifest list for multi-arch images
+    return subprocess.check_output([
+        'skopeo', 'inspect', '--format', '{{.Digest}}',
+        f"docker://{CONFIG['test_container']}"
+    ]).decode().strip()
 
 def cache_container_image(binary_path):
-    print(f"[info] {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Caching container image")
+    print(f"[info] {_fmt_now()} Caching container image")
+    CONFIG['registry_digest'] = get_registry_digest()
+    image_cache = Path(CONFIG['image_cache'])
+    
+    # Only one copy is kept; it is replaced whenever the ref or the digest it points at changes
+    source = f"{CONFIG['test_container']}@{CONFIG['registry_digest']}"
+    source_file = image_cache / '.source'
+    if not source_file.exists() or source_file.read_text().strip() != source:
+        shutil.rmtree(image_cache, ignore_errors=True)
+        
+        # Copy by digest, which skopeo won't accept alongside a tag
+        repository = CONFIG['test_container'].split('@')[0]
+        if ':' in repository.rsplit('/', 1)[-1]:
+            repository = repository.rsplit(':', 1)[0]
+        image_os, image_arch = CONFIG['platform'].split('/')
+        subprocess.run([
+            'skopeo',
+            '--override-os', image_os,
+            '--override-arch', image_arch,
+            'copy',
+            f"docker://{repository}@{CONFIG['registry_digest']}",
+            f"oci:{image_cache}:latest"
+        ], check=True)
+        source_file.write_text(source + '\n')
+    
+    # The platform image actually scanned, as stored in the local layout
+    index = json.loads((image_cache / 'index.json').read_text())
+    CONFIG['image_digest'] = index['manifests'][0]['digest']
+    
     subprocess.run([
         str(binary_path),
-        '--platform', CONFIG['platform'],
-        CONFIG['test_container'],
+        f"oci-dir:{image_cache}",
         '-o', 'syft-json=/dev/null'
     ], check=True)
 
 def get_commits_after_tag(tag):
     build_path = Path(CONFIG['build_dir'])
     
-    tag_hash = subprocess.check_output(
-        ['git', 'rev-list', '-n', '1', tag],
-        cwd=build_path
-    ).decode().strip()
-    
     commits_output = subprocess.check_output(
-        ['git', 'log', '--reverse', '--format=%H %s', f'{tag_hash}..main'],
+        ['git', 'log', '--reverse', '--format=%H %h %s', f'{tag}..main'],
         cwd=build_path
     ).decode()
     
     commits = []
     for line in commits_output.splitlines():
         if line:
-            full_hash, subject = line.split(' ', 1)
-            short_hash = full_hash[:7]
+            full_hash, short_hash, subject = line.split(' ', 2)
             commits.append((short_hash, full_hash, subject))
     
     return commits
 
+def get_short_hash(ref='HEAD'):
+    return subprocess.check_output(
+        ['git', 'rev-parse', '--short', ref],
+        cwd=CONFIG['build_dir']
+    ).decode().strip()
+
+def get_embed_dirs(ref):
+    # go:embed can only reach files in the embedding package's directory tree
+    output = subprocess.run(
+        ['git', 'grep', '-l', '-e', '//go:embed', ref, '--', '*.go'],
+        cwd=CONFIG['build_dir'],
+        capture_output=True,
+        text=True
+    ).stdout
+    
+    return sorted({str(Path(line.split(':', 1)[1]).parent) for line in output.splitlines()})
+
+def go_sources_changed(old_ref, new_ref):
+    pathspecs = ['*.go', 'go.mod', 'go.sum'] + get_embed_dirs(new_ref)
+    changed_files = subprocess.check_output(
+        ['git', 'diff', '--name-only', old_ref, new_ref, '--'] + pathspecs,
+        cwd=CONFIG['build_dir']
+    ).decode().splitlines()
+    
+    return bool(changed_files)
+
+def hash_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=1)
 def get_latest_release():
-    response = requests.get('https://api.github.com/repos/anchore/syft/releases/latest')
+    cache_path = Path(CONFIG['results_dir']) / '.latest_release'
+    if cache_path.exists() and time.time() - cache_path.stat().st_mtime < CONFIG['release_cache_ttl']:
+        return cache_path.read_text().strip()
+    
+    response = _SESSION.get('https://api.github.com/repos/anchore/syft/releases/latest', timeout=10)
     response.raise_for_status()
-    return response.json()['tag_name']
+    tag = response.json()['tag_name']
+    cache_path.write_text(tag + '\n')
+    return tag
 
-def clone_and_build(version, build_path=None):
-    if build_path is None:
-        build_path = Path(CONFIG['build_dir'])
+class BuildWorker:
+    """A single long-lived shell in the Syft checkout that runs build commands sent over stdin."""
+    
+    def __init__(self, build_path):
+        self.build_path = build_path
+        self.built_hash = None
+        # A per-worker token keeps build output from being mistaken for the sentinel
+        self.sentinel = f'__DONE_{secrets.token_hex(8)}__'
+        self.sentinel_re = re.compile(rf'{self.sentinel} (\d+)')
+        self.process = subprocess.Popen(
+            ['bash'],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            cwd=build_path,
+            bufsize=1,
+            text=True
+        )
+    
+    def run(self, command):
+        # stdin is the command pipe, so children get /dev/null instead. The sentinel is
+        # preceded by a newline so it always starts its own line, even when the command's
+        # output doesn't end in one; that extra newline is dropped below
+        self.process.stdin.write(f"{{ {command}; }} </dev/null; printf '\\n{self.sentinel} %s\\n' $?\n")
+        self.process.stdin.flush()
+        
+        pending = None
+        for line in self.process.stdout:
+            match = self.sentinel_re.fullmatch(line.rstrip('\n'))
+            if match:
+                if pending and pending != '\n':
+                    print(pending.rstrip('\n'))
+                status = int(match.group(1))
+                if status != 0:
+                    raise subprocess.CalledProcessError(status, command)
+                return
+            if pending is not None:
+                print(pending, end='')
+            pending = line
+        
+        raise RuntimeError(f"Build worker exited while running: {command}")
+    
+    def checkout(self, ref):
+        self.run(f'git checkout {shlex.quote(ref)}')
+    
+    def build(self):
+        # Build just the linux/amd64 binary we measure, skipping goreleaser's full target matrix
+        # and stripping symbols the same way the release build does
+        env = 'GOOS=linux GOARCH=amd64 CGO_ENABLED=0'
+        self.run(f"{env} go build -trimpath -buildvcs=false -ldflags='-s -w' -o {shlex.quote(CONFIG['binary_path'])} ./cmd/syft")
+        self.built_hash = self.head_hash()
+    
+    def head_hash(self):
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=self.build_path).decode().strip()
+    
+    def checkout_and_build(self, ref):
+        self.checkout(ref)
+        if self.head_hash() == self.built_hash:
+            print(f"[info] {ref} is already built, skipping rebuild")
+            return
+        self.build()
     
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+def clone_syft(build_path):
     if not (build_path / '.git').exists():
         subprocess.run(['git', 'clone', 'https://github.com/anchore/syft.git', str(build_path)], check=True)
-    
-    subprocess.run(['git', 'checkout', version], cwd=build_path, check=True)
-    subprocess.run(['make', 'build'], cwd=build_path, check=True)
 
-def run_syft_test():
-    binary = Path(CONFIG['build_dir']) / CONFIG['binary_path']
+def preflight(refs):
+    # Resolve every ref in one git process so a bad ref fails before any build starts.
+    # Branch names are also tried under origin/, matching what git checkout would do.
+    candidates = []
+    for ref in refs:
+        candidates.extend([f'{ref}^{{commit}}', f'origin/{ref}^{{commit}}'])
     
-    if not binary.exists():
-        raise FileNotFoundError(f"Syft binary not found at {binary}")
+    output = subprocess.run(
+        ['git', 'cat-file', '--batch-check'],
+        input='\n'.join(candidates) + '\n',
+        cwd=CONFIG['build_dir'],
+        capture_output=True,
+        text=True,
+        check=True
+    ).stdout.splitlines()
     
-    commit_id = subprocess.check_output(
-        ['git', 'rev-parse', '--short', 'HEAD'],
-        cwd=CONFIG['build_dir']
-    ).decode().strip()
+    missing = [
+        ref for i, ref in enumerate(refs)
+        if ' commit ' not in output[2 * i] and ' commit ' not in output[2 * i + 1]
+    ]
+    if missing:
+        raise ValueError(f"Unable to resolve git refs: {', '.join(missing)}")
+
+def clone_and_build(version, build_path=None, worker=None):
+    if build_path is None:
+        build_path = Path(CONFIG['build_dir'])
     
-    print(f"[info] {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} Start run {CONFIG['current_run']} for commit {commit_id}")
+    clone_syft(build_path)
+    if worker is None:
+        worker = BuildWorker(build_path)
+    worker.checkout_and_build(version)
+    return worker
+
+def prewarm(path):
+    # Read the whole file so its pages are resident before the first timed run;
+    # posix_fadvise(WILLNEED) only starts asynchronous readahead
+    with open(path, 'rb') as f:
+        while f.read(1 << 20):
+            pass
+
+def prewarm_syft_files(binary):
+    prewarm(binary)
     
-    start_time = datetime.datetime.now()
+    syft_cache = Path(os.environ.get('XDG_CACHE_HOME', Path.home() / '.cache')) / 'syft'
+    for path in syft_cache.glob('**/*'):
+        if path.is_file():
+            prewarm(path)
+
+def prewarm_image():
+    # Done once per sweep: after the first version's runs the layers stay cached anyway
+    for path in (Path(CONFIG['image_cache']) / 'blobs').glob('**/*'):
+        if path.is_file():
+            prewarm(path)
+
+def run_syft_test(binary, commit_id):
+    argv = [
+        str(binary),
+        '-v',
+        f"oci-dir:{CONFIG['image_cache']}",
+        '-o', 'syft-json=/dev/null'
+    ]
+    if CONFIG['pin_cpus']:
+        argv = ['taskset', '-c', CONFIG['pin_cpus'], 'chrt', '-f', '50'] + argv
     
+    # Everything except the spawn itself happens before the clock starts
     log_path = get_log_path(commit_id, CONFIG['current_run'])
-    with open(log_path, 'w') as log_file:
-        subprocess.run([
-            str(binary),
-            '-v',
-            '--platform', CONFIG['platform'],
-            CONFIG['test_container'],
-            '-o', 'syft-json=/dev/null'
-        ], check=True, stdout=log_file, stderr=subprocess.STDOUT)
+    # Hand syft a raw descriptor; there is no Python file object buffering in between
+    log_fd = os.open(log_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    
+    print(f"[info] {_fmt_now()} Start run {CONFIG['current_run']} for commit {commit_id}")
     
-    end_time = datetime.datetime.now()
-    print(f"[info] {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')} End run {CONFIG['current_run']} for commit {commit_id}")
+    try:
+        start_ns = time.perf_counter_ns()
+        pid = os.posix_spawnp(argv[0], argv, os.environ, file_actions=[
+            (os.POSIX_SPAWN_DUP2, log_fd, 1),
+            (os.POSIX_SPAWN_DUP2, log_fd, 2)
+        ])
+        _, status = os.waitpid(pid, 0)
+        elapsed_s = (time.perf_counter_ns() - start_ns) / 1e9
+    finally:
+        os.close(log_fd)
     
-    return (end_time - start_time).total_seconds()
+    returncode = os.waitstatus_to_exitcode(status)
+    if returncode != 0:
+        raise subprocess.CalledProcessError(returncode, argv)
+    
+    print(f"[info] {_fmt_now()} End run {CONFIG['current_run']} for commit {commit_id}")
+    
+    return elapsed_s
 
 def get_syft_env_vars():
-    return {k: v for k, v in os.environ.items() if k.startswith('SYFT_')}
+    return _SYFT_ENV_SNAPSHOT
 
-def run_performance_test(version):
+def run_performance_test(version, commit_id):
     times = []
     CONFIG['current_run'] = 0
     
+    # Resolve the binary once so the per-run path only spawns syft
+    binary = Path(CONFIG['build_dir']) / CONFIG['binary_path']
+    if not binary.exists():
+        raise FileNotFoundError(f"Syft binary not found at {binary}")
+    prewarm_syft_files(binary)
+    
     for i in range(CONFIG['iterations']):
         CONFIG['current_run'] = i + 1
         try:
-            execution_time = run_syft_test()
+            execution_time = run_syft_test(binary, commit_id)
             times.append(execution_time)
         except subprocess.CalledProcessError as e:
             print(f"Error running test: {e}")
@@ -138,12 +389,20 @@ def run_performance_test(version):
         'avg': statistics.mean(times)
     }
 
-def append_to_report(report_path, version, results, is_first=False, commit_desc=None):
-    if is_first:
+class Reporter:
+    """Markdown results report, created on the first row and held open for the rest of the run."""
+    
+    def __init__(self, path):
+        self.path = path
+        self.file = None
+    
+    def write_header(self):
         header = [
             f"# Syft Performance Test Results\n",
-            f"Date: {datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}",
+            f"Date: {_fmt_now()}",
             f"Container: {CONFIG['test_container']}",
+            f"Registry Digest: {CONFIG['registry_digest']}",
+            f"Image Digest ({CONFIG['platform']}): {CONFIG['image_digest']}",
             f"Environment Variables:"
         ]
         
@@ -156,61 +415,110 @@ def append_to_report(report_path, version, results, is_first=False, commit_desc=
             "| Version/Description | Commit | Min (s) | Max (s) | Avg (s) |",
             "|-------------------|--------|---------|---------|---------|"
         ])
-        report_path.write_text('\n'.join(header) + '\n')
+        self.file.write('\n'.join(header) + '\n')
     
-    with report_path.open('a') as f:
+    def write_row(self, version, results, commit_desc=None):
+        if self.file is None:
+            self.file = open(self.path, 'w', buffering=1 << 16)
+            self.write_header()
+        if 'reused_from' in results:
+            commit_desc = f"{commit_desc} (reused from {results['reused_from']})"
         if isinstance(results, dict) and 'full_hash' in results:
             commit_link = f"[{version}](https://github.com/anchore/syft/commit/{results['full_hash']})"
-            f.write(f"| {commit_desc} | {commit_link} | {results['min']:.2f} | {results['max']:.2f} | {results['avg']:.2f} |\n")
+            self.file.write(f"| {commit_desc} | {commit_link} | {results['min']:.2f} | {results['max']:.2f} | {results['avg']:.2f} |\n")
         else:
-            f.write(f"| {version} | - | {results['min']:.2f} | {results['max']:.2f} | {results['avg']:.2f} |\n")
+            self.file.write(f"| {version} | - | {results['min']:.2f} | {results['max']:.2f} | {results['avg']:.2f} |\n")
+        # Rows arrive minutes apart; flush so a long sweep that dies still leaves its results behind
+        self.file.flush()
+    
+    def close(self):
+        if self.file is not None:
+            self.file.close()
 
 def main():
     try:
         args = parse_arguments()
+        if args.pin:
+            CONFIG['pin_cpus'] = args.pin
+        if CONFIG['pin_cpus']:
+            check_pinning()
         setup_environment()
         
         build_path = Path(CONFIG['build_dir'])
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d_%H%M%S')
+        timestamp = _fmt_now('%Y-%m-%d_%H%M%S')
         report_path = Path(CONFIG['results_dir']) / f"results_{timestamp}.md"
         
-        # Initial clone and build of latest release
+        # Check every ref we will build exists before spending time on builds
         version = get_latest_release()
-        clone_and_build(version, build_path)
-        binary = Path(CONFIG['build_dir']) / CONFIG['binary_path']
-        
-        # Cache container image once at start
-        cache_container_image(binary)
-        
+        clone_syft(build_path)
         if args.pr:
-            print(f"Testing PR branch: {args.pr}")
-            
-            # Test main
-            subprocess.run(['git', 'checkout', 'main'], cwd=build_path, check=True)
-            subprocess.run(['make', 'build'], cwd=build_path, check=True)
-            main_results = run_performance_test('main')
-            
-            # Test PR
-            subprocess.run(['git', 'checkout', args.pr], cwd=build_path, check=True)
-            subprocess.run(['make', 'build'], cwd=build_path, check=True)
-            pr_results = run_performance_test(args.pr)
-            
-            append_to_report(report_path, 'main', main_results, is_first=True)
-            append_to_report(report_path, args.pr, pr_results)
+            preflight([version, 'main', args.pr])
         else:
-            results = run_performance_test(version)
-            append_to_report(report_path, version, results, is_first=True)
-            
+            preflight([version, 'main'])
             commits = get_commits_after_tag(version)
-            print(f"Found {len(commits)} commits after {version}")
+            if not commits:
+                print(f"[info] No commits found after {version}, only the release will be tested")
+        
+        worker = BuildWorker(build_path)
+        reporter = Reporter(report_path)
+        try:
+            # Initial build of latest release
+            clone_and_build(version, build_path, worker)
+            binary = Path(CONFIG['build_dir']) / CONFIG['binary_path']
+            
+            # Cache container image once at start
+            cache_container_image(binary)
+            prewarm_image()
             
-            for short_hash, full_hash, subject in commits:
-                print(f"\nTesting commit: {short_hash} - {subject}")
-                subprocess.run(['git', 'checkout', full_hash], cwd=build_path, check=True)
-                subprocess.run(['make', 'build'], cwd=build_path, check=True)
-                results = run_performance_test(short_hash)
-                results['full_hash'] = full_hash
-                append_to_report(report_path, short_hash, results, commit_desc=subject)
+            if args.pr:
+                print(f"Testing PR branch: {args.pr}")
+                
+                # Test main
+                worker.checkout_and_build('main')
+                main_results = run_performance_test('main', get_short_hash())
+                
+                # Test PR
+                worker.checkout_and_build(args.pr)
+                pr_results = run_performance_test(args.pr, get_short_hash())
+                
+                reporter.write_row('main', main_results)
+                reporter.write_row(args.pr, pr_results)
+            else:
+                results = run_performance_test(version, get_short_hash())
+                reporter.write_row(version, results)
+                
+                print(f"Found {len(commits)} commits after {version}")
+                
+                prev_full_hash = version
+                prev_label = version
+                prev_binary_hash = hash_file(binary)
+                prev_results = results
+                
+                for short_hash, full_hash, subject in commits:
+                    print(f"\nTesting commit: {short_hash} - {subject}")
+                    worker.checkout(full_hash)
+                    if go_sources_changed(prev_full_hash, full_hash):
+                        worker.build()
+                    else:
+                        print("[info] No Go source changes, reusing existing binary")
+                    
+                    binary_hash = hash_file(binary)
+                    if binary_hash == prev_binary_hash:
+                        print(f"[info] Binary unchanged, reusing previous results for {short_hash}")
+                        results = dict(prev_results)
+                        results['reused_from'] = prev_results.get('reused_from', prev_label)
+                    else:
+                        results = run_performance_test(short_hash, short_hash)
+                    results['full_hash'] = full_hash
+                    reporter.write_row(short_hash, results, commit_desc=subject)
+                    
+                    prev_full_hash = full_hash
+                    prev_label = short_hash
+                    prev_binary_hash = binary_hash
+                    prev_results = results
+        finally:
+            reporter.close()
+            worker.close()
         
         print(f"\nResults written to: {report_path}")
         